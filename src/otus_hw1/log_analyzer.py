@@ -2,19 +2,25 @@
 
 import argparse
 import configparser
-import gzip
+import contextlib
+import functools
+import heapq
 import json
+import mmap
+import multiprocessing
 import os
 import re
 import sys
-from collections.abc import Generator, Mapping
-from dataclasses import asdict, dataclass
+import zlib
+from array import array
+from collections import defaultdict
+from collections.abc import Generator, Iterable, Mapping
+from dataclasses import dataclass, field
 from datetime import MINYEAR, date
 from pathlib import Path
-from statistics import mean, median
-from string import Template
 from typing import Any, Dict, List, NamedTuple
 
+import numpy as np
 import structlog
 
 # log_format ui_short '$remote_addr  $remote_user '
@@ -24,6 +30,30 @@ import structlog
 #                     '"$http_X_REQUEST_ID" "$http_X_RB_USER" '
 #                     '$request_time';
 
+# nginx-access-ui.log-YYYYMMDD с необязательным расширением gz
+_LOG_NAME_RE = re.compile(
+    r"^nginx-access-ui\.log-"
+    + r"2\d\d\d"  # Год
+    + r"((0[1-9])|(1[0-2]))"  # Месяц
+    + r"(([0-2]\d)|(3[0-1]))"  # День
+    + r"(\.gz){0,1}$"
+)  # Расширение
+
+# Запрос GET/POST: URL и время обработки запроса в конце строки
+_LOG_LINE_RE = re.compile(
+    rb'"(?:GET|POST) (\S+) [^"\n]*"'  # URL из "$request"
+    + rb".* (\d+(?:\.\d+)?)[ \t\r]*$",  # $request_time
+    re.MULTILINE,
+)
+# Размер блока сжатых данных при чтении архива лога
+GZIP_BLOCK_SIZE = 256 * 1024
+# Распаковка zlib с заголовком gzip
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+# Размер части неархивированного лога при подсчете строк
+LINE_COUNT_BLOCK_SIZE = 4 * 1024 * 1024
+# Минимальный размер лога для обработки в нескольких процессах
+PARALLEL_MIN_SIZE = 64 * 1024 * 1024
+
 type ConfigMapping = Mapping[str, str]
 type ConfigType = Dict[str, str]
 
@@ -36,7 +66,21 @@ config: ConfigType = {
 }
 
 
-type LogGrouped = Dict[str, List[float]]
+@dataclass(slots=True)
+class UrlAccum:
+    """Накопленные данные по URL."""
+
+    # количество запросов
+    count: int = 0
+    # суммарное время запросов
+    time_sum: float = 0
+    # максимальное время запроса
+    time_max: float = 0
+    # время запросов для расчета медианы
+    times: array[float] = field(default_factory=lambda: array("d"))
+
+
+type LogGrouped = Dict[str, UrlAccum]
 
 
 class LogInfo(NamedTuple):
@@ -45,6 +89,8 @@ class LogInfo(NamedTuple):
     url_count: int = 0
     url_total_time: float = 0
     log_grouped: LogGrouped = {}
+    # количество строк, не соответствующих формату лога
+    skipped_count: int = 0
 
 
 class FileInfo(NamedTuple):
@@ -55,14 +101,11 @@ class FileInfo(NamedTuple):
     is_archive: bool = False
 
 
-class UrlInfo(NamedTuple):
-    """Распарсенные данные из файла лога."""
-
-    url: str = ""
-    requestTime: float = 0
+# Распарсенные данные из файла лога: URL и время запроса
+type UrlInfo = tuple[str, float]
 
 
-@dataclass
+@dataclass(slots=True)
 class UrlStats:
     """Статистика из файла лога."""
 
@@ -86,6 +129,19 @@ class UrlStats:
 # Таблица статистики
 type UrlStatsTab = List[UrlStats]
 
+# Место вставки таблицы статистики в шаблоне отчета
+TABLE_PLACEHOLDER = "$table_json"
+
+# Поля статистики, округляемые в отчете
+FLOAT_FIELDS = (
+    "count_perc",
+    "time_sum",
+    "time_perc",
+    "time_avg",
+    "time_max",
+    "time_med",
+)
+
 
 def get_project_root() -> Path:
     """Получение пути к проекту.
@@ -101,24 +157,17 @@ def get_log_file_name(path: Path) -> FileInfo:
     :arg path - путь к каталогу с логами
     :return: Кортеж имени файла, даты и признака архива
     """
-    # nginx-access-ui.log-YYYYMMDD с необязательным расширением gz
-    pattern = re.compile(
-        r"^nginx-access-ui\.log-"
-        + r"2\d\d\d"  # Год
-        + r"((0[1-9])|(1[0-2]))"  # Месяц
-        + r"(([0-2]\d)|(3[0-1]))"  # День
-        + r"(\.gz){0,1}$"
-    )  # Расширение
     # Список файлов (исключая папки) по заданной маске
-    file_list = [
-        s
-        for s in os.listdir(path=path)
-        if pattern.match(s) and os.path.isfile(os.path.join(path, s))
-    ]
+    with os.scandir(path) as dir_entries:
+        file_list = [
+            (entry.name, entry.path)
+            for entry in dir_entries
+            if _LOG_NAME_RE.match(entry.name) and entry.is_file()
+        ]
     # Минимальная дата для сравнения
     result = FileInfo()
 
-    for file_name in file_list:
+    for file_name, file_path in file_list:
         # Парсим дату из имени файла. Отсутствие ошибок конверсии гарантировано
         # проверкой по маске
         file_date = date(
@@ -129,9 +178,9 @@ def get_log_file_name(path: Path) -> FileInfo:
         # Сохраняем имя файла, если дата в имени больше сохраненной
         if file_date > result.f_date:
             result = FileInfo(
-                name=os.path.join(path, file_name),
+                name=file_path,
                 f_date=file_date,
-                is_archive=file_name[-2:].lower() == "gz",
+                is_archive=file_name.endswith(".gz"),
             )
     return result
 
@@ -166,21 +215,12 @@ def extract_url(log_line: str) -> str:
     :return: url
     """
     err_logger = structlog.stdlib.get_logger()
-    # URL начинается через пробел от команды GET/POST
-    url_off_start = log_line.find("GET", 0)
-    url_start_shift = 4  # GET + пробел
-    if url_off_start == -1:
-        url_off_start = log_line.find("POST", 0)
-        url_start_shift = 5  # POST + пробел
-    # Ищем следующий за URL пробел
-    # Недействительный начальный адрес -1+4=3
-    url_off_end = (
-        log_line.find(" ", url_off_start + url_start_shift)
-        if url_off_start != -1
-        else -1
-    )
-    if url_off_start != -1 and url_off_end != -1:
-        return log_line[url_off_start + url_start_shift : url_off_end]
+    # URL следует через пробел за командой GET/POST в начале "$request"
+    _, _, request = log_line.partition('"')
+    method, _, url_part = request.partition(" ")
+    url_off_end = url_part.find(" ")
+    if method in ("GET", "POST") and url_off_end > 0:
+        return url_part[:url_off_end]
     else:
         err_logger.error("URL value not found", start=log_line[:15])
         return ""
@@ -211,50 +251,284 @@ def extract_time(log_line: str) -> float:
         return 0
 
 
-def parse_log_file(file_info: FileInfo) -> Generator[UrlInfo, None, None]:
+def count_lines(buffer: bytes | mmap.mmap, start_pos: int, end_pos: int) -> int:
+    """Подсчет строк в блоке лога.
+
+    :arg buffer - блок строк лога
+    :arg start_pos - начало блока
+    :arg end_pos - конец блока
+    :return: количество строк
+    """
+    if start_pos >= end_pos:
+        return 0
+    if isinstance(buffer, mmap.mmap):
+        # У mmap нет метода count, считаем по частям
+        line_count = sum(
+            buffer[pos : min(pos + LINE_COUNT_BLOCK_SIZE, end_pos)].count(b"\n")
+            for pos in range(start_pos, end_pos, LINE_COUNT_BLOCK_SIZE)
+        )
+    else:
+        line_count = buffer.count(b"\n", start_pos, end_pos)
+    # Последняя строка без перевода строки
+    if buffer[end_pos - 1] != ord("\n"):
+        line_count += 1
+    return line_count
+
+
+def scan_log_buffer(
+    buffer: bytes | mmap.mmap, end_pos: int, start_pos: int = 0
+) -> Generator[UrlInfo, None, int]:
+    """Парсинг блока строк лога.
+
+    :arg buffer - блок целых строк лога
+    :arg end_pos - граница сканирования блока
+    :arg start_pos - начало сканирования блока
+    :return: URL и время запроса, в конце - количество нераспознанных строк
+    """
+    parsed_count = 0
+    # URL непустой по шаблону, строки с нулевым временем пропускаем
+    for match in _LOG_LINE_RE.finditer(buffer, start_pos, end_pos):
+        parsed_count += 1
+        request_time = float(match.group(2))
+        if request_time:
+            yield match.group(1).decode("utf-8", "replace"), request_time
+    return count_lines(buffer, start_pos, end_pos) - parsed_count
+
+
+def read_archive_blocks(file_name: str) -> Generator[bytes, None, None]:
+    """Чтение архива лога блоками с распаковкой.
+
+    :arg file_name - имя файла архива
+    :return: Блоки распакованных данных лога
+    """
+    err_logger = structlog.stdlib.get_logger()
+    with open(file_name, "rb") as file:
+        decompressor = zlib.decompressobj(GZIP_WBITS)
+        while block := file.read(GZIP_BLOCK_SIZE):
+            yield decompressor.decompress(block)
+            # Архив может состоять из нескольких gzip-потоков,
+            # после последнего допускается заполнение нулями
+            while decompressor.eof and decompressor.unused_data:
+                unused_data = decompressor.unused_data.lstrip(b"\x00")
+                if not unused_data:
+                    break
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+                yield decompressor.decompress(unused_data)
+        if not decompressor.eof:
+            err_logger.error("Log archive is truncated", path=file_name)
+
+
+@contextlib.contextmanager
+def map_log_file(file_name: str) -> Generator[mmap.mmap, None, None]:
+    """Отображение неархивированного лога в память только для чтения.
+
+    :arg file_name - имя файла лога
+    :return: Отображение файла
+    """
+    with (
+        open(file_name, "rb") as file,
+        mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as log_map,
+    ):
+        yield log_map
+
+
+def scan_plain_log(file_name: str) -> Generator[UrlInfo, None, int]:
+    """Парсинг неархивированного лога, отображенного в память.
+
+    :arg file_name - имя файла лога
+    :return: URL и время запроса, в конце - количество нераспознанных строк
+    """
+    # Пустой файл нельзя отобразить в память
+    if os.path.getsize(file_name) == 0:
+        return 0
+    with map_log_file(file_name) as log_map:
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            log_map.madvise(mmap.MADV_SEQUENTIAL)
+        return (yield from scan_log_buffer(log_map, len(log_map)))
+
+
+def parse_log_file(file_info: FileInfo) -> Generator[UrlInfo, None, int]:
     """Парсинг файла лога.
 
     :arg file_info - кортеж с именем и датой файла
-    :return: Путь к папке
+    :return: URL и время запроса, в конце - количество нераспознанных строк
     """
     err_logger = structlog.stdlib.get_logger()
     if not os.access(file_info.name, mode=os.R_OK):
         err_logger.error("Access to log file denied", path=file_info.name)
-        return
-
-    with (
-        open(file_info.name, "r", encoding="utf-8")
-        if not file_info.is_archive
-        else gzip.open(file_info.name, "rt", encoding="utf-8") as file
-    ):
-        for logLine in file:
-            yield UrlInfo(url=extract_url(logLine), requestTime=extract_time(logLine))
+        return 0
 
+    if not file_info.is_archive:
+        return (yield from scan_plain_log(file_info.name))
 
-def process_log(file_attr: FileInfo) -> LogInfo:
-    """Обработка файла лога.
-
-    :arg file_attr - кортеж с именем и датой файла
+    skipped_count = 0
+    tail = b""
+    for block in read_archive_blocks(file_info.name):
+        line_end = block.find(b"\n") + 1
+        if line_end == 0:
+            tail += block
+            continue
+        # Неполную строку предыдущего блока дополняем началом текущего
+        line = tail + block[:line_end]
+        skipped_count += yield from scan_log_buffer(line, len(line))
+        # Целые строки блока сканируем без копирования,
+        # неполную последнюю строку переносим в следующий блок
+        split_pos = block.rfind(b"\n") + 1
+        skipped_count += yield from scan_log_buffer(block, split_pos, line_end)
+        tail = block[split_pos:]
+    skipped_count += yield from scan_log_buffer(tail, len(tail))
+    return skipped_count
+
+
+def group_url_info(url_infos: Generator[UrlInfo, None, int]) -> LogInfo:
+    """Группировка запросов по URL.
+
+    :arg url_infos - URL и время запросов, в конце - количество нераспознанных строк
     :return: Сгруппированные URL
     """
-    log_grouped: LogGrouped = {}
+    log_grouped: LogGrouped = defaultdict(UrlAccum)
     url_count = 0
     url_total_time = float(0)
-    for url_info in parse_log_file(file_attr):
-        if url_info.url == "" or url_info.requestTime == 0:
-            continue
+    skipped_count = 0
+
+    def read_url_infos() -> Generator[UrlInfo, None, None]:
+        nonlocal skipped_count
+        skipped_count = yield from url_infos
+
+    for url, request_time in read_url_infos():
         # Счетчик обращений к серверу
         url_count += 1
         # Общее время обращения к серверу
-        url_total_time += url_info.requestTime
+        url_total_time += request_time
         # Группируем запросы по URL
-        log_grouped.setdefault(url_info.url, []).append(url_info.requestTime)
+        url_accum = log_grouped[url]
+        url_accum.count += 1
+        url_accum.time_sum += request_time
+        if request_time > url_accum.time_max:
+            url_accum.time_max = request_time
+        url_accum.times.append(request_time)
 
     return LogInfo(
-        url_count=url_count, url_total_time=url_total_time, log_grouped=log_grouped
+        url_count=url_count,
+        url_total_time=url_total_time,
+        log_grouped=log_grouped,
+        skipped_count=skipped_count,
     )
 
 
+def split_log_ranges(file_name: str, parts: int) -> List[tuple[int, int]]:
+    """Разбиение лога на диапазоны целых строк.
+
+    :arg file_name - имя файла лога
+    :arg parts - желаемое количество диапазонов
+    :return: Начало и конец каждого диапазона
+    """
+    with map_log_file(file_name) as log_map:
+        size = len(log_map)
+        bounds = [0]
+        for part in range(1, parts):
+            # Граница диапазона сдвигается на начало следующей строки
+            line_end = log_map.find(b"\n", max(size * part // parts, bounds[-1]))
+            if line_end == -1:
+                break
+            bounds.append(line_end + 1)
+        bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def process_log_range(file_name: str, start_pos: int, end_pos: int) -> LogInfo:
+    """Обработка диапазона строк лога в отдельном процессе.
+
+    :arg file_name - имя файла лога
+    :arg start_pos - начало диапазона
+    :arg end_pos - конец диапазона
+    :return: Сгруппированные URL диапазона
+    """
+    with map_log_file(file_name) as log_map:
+        return group_url_info(scan_log_buffer(log_map, end_pos, start_pos))
+
+
+def merge_log_info(log_infos: Iterable[LogInfo]) -> LogInfo:
+    """Объединение сгруппированных URL.
+
+    :arg log_infos - сгруппированные URL частей лога
+    :return: Сгруппированные URL всего лога
+    """
+    log_grouped: LogGrouped = {}
+    url_count = 0
+    url_total_time = float(0)
+    skipped_count = 0
+    for log_info in log_infos:
+        url_count += log_info.url_count
+        url_total_time += log_info.url_total_time
+        skipped_count += log_info.skipped_count
+        for url, part_accum in log_info.log_grouped.items():
+            url_accum = log_grouped.get(url)
+            if url_accum is None:
+                log_grouped[url] = part_accum
+                continue
+            url_accum.count += part_accum.count
+            url_accum.time_sum += part_accum.time_sum
+            url_accum.time_max = max(url_accum.time_max, part_accum.time_max)
+            url_accum.times.extend(part_accum.times)
+
+    return LogInfo(
+        url_count=url_count,
+        url_total_time=url_total_time,
+        log_grouped=log_grouped,
+        skipped_count=skipped_count,
+    )
+
+
+def process_log(file_attr: FileInfo) -> LogInfo:
+    """Обработка файла лога.
+
+    :arg file_attr - кортеж с именем и датой файла
+    :return: Сгруппированные URL
+    """
+    err_logger = structlog.stdlib.get_logger()
+    # Большой неархивированный лог обрабатываем по частям в нескольких процессах
+    workers = os.cpu_count() or 1
+    if (
+        not file_attr.is_archive
+        and workers > 1
+        and os.access(file_attr.name, mode=os.R_OK)
+        and os.path.getsize(file_attr.name) >= PARALLEL_MIN_SIZE
+    ):
+        log_ranges = split_log_ranges(file_attr.name, workers)
+        with multiprocessing.Pool(len(log_ranges)) as pool:
+            log_infos = pool.starmap(
+                process_log_range,
+                [(file_attr.name, start, end) for start, end in log_ranges],
+            )
+        log_info = merge_log_info(log_infos)
+    else:
+        log_info = group_url_info(parse_log_file(file_attr))
+
+    if log_info.skipped_count:
+        err_logger.error(
+            "Log lines not parsed",
+            path=file_attr.name,
+            skipped=log_info.skipped_count,
+            requests=log_info.url_count,
+        )
+    return log_info
+
+
+def calc_median(times: np.ndarray) -> float:
+    """Вычисление медианы частичной сортировкой.
+
+    :arg times - время запросов
+    :return: медиана
+    """
+    mid = times.size // 2
+    if times.size % 2:
+        return float(np.partition(times, mid)[mid])
+    # Для четного количества нужны оба средних элемента
+    part = np.partition(times, (mid - 1, mid))
+    return float(part[mid - 1] + part[mid]) / 2
+
+
 def gather_stats(log_info: LogInfo, report_size: int) -> UrlStatsTab:
     """Сбор статистики лога.
 
@@ -264,42 +538,54 @@ def gather_stats(log_info: LogInfo, report_size: int) -> UrlStatsTab:
     """
     err_logger = structlog.stdlib.get_logger()
     url_stats: UrlStatsTab = []
-    for grp_key in log_info.log_grouped:
-        grp_array = log_info.log_grouped[grp_key]
-        grp_len = len(grp_array)
-        grp_total = sum(grp_array)
-        try:
-            url_stats.append(
-                UrlStats(
-                    url=grp_key,
-                    count=grp_len,
-                    count_perc=grp_len / log_info.url_count * 100,
-                    time_sum=grp_total,
-                    time_perc=grp_total / log_info.url_total_time * 100,
-                    time_avg=mean(grp_array),
-                    time_max=max(grp_array),
-                    time_med=median(grp_array),
-                )
+    if not log_info.log_grouped:
+        return url_stats
+    # Коэффициенты для расчета процентов вычисляем один раз
+    try:
+        count_perc_coef = 100 / log_info.url_count
+        time_perc_coef = 100 / log_info.url_total_time
+    except ZeroDivisionError:
+        err_logger.error("Division by zero")
+        return url_stats
+    # Полная статистика нужна только для URL с наибольшим суммарным временем
+    top_groups = heapq.nlargest(
+        report_size, log_info.log_grouped.items(), key=lambda grp: grp[1].time_sum
+    )
+    for grp_key, url_accum in top_groups:
+        grp_len = url_accum.count
+        grp_total = url_accum.time_sum
+        # Массив времени запросов без копирования данных
+        grp_times = np.frombuffer(url_accum.times, dtype=np.float64)
+        url_stats.append(
+            UrlStats(
+                url=grp_key,
+                count=grp_len,
+                count_perc=grp_len * count_perc_coef,
+                time_sum=grp_total,
+                time_perc=grp_total * time_perc_coef,
+                time_avg=grp_total / grp_len,
+                time_max=url_accum.time_max,
+                time_med=calc_median(grp_times),
             )
-        except ZeroDivisionError:
-            err_logger.error("Division by zero")
-    url_stats.sort(key=lambda x: x.time_sum, reverse=True)
-    return url_stats[:report_size]
+        )
+    return url_stats
 
 
-def round_floats(src: Any) -> Any:
-    """Округление float при преобразовании в JSON.
+def stats_to_json(url_stats: UrlStatsTab) -> str:
+    """Преобразование статистики в JSON с округлением float.
 
-    :arg src - исходные данные
-    :return: округленные данные
+    :arg url_stats - статистика URL
+    :return: JSON-таблица для отчета
     """
-    if isinstance(src, float):
-        return round(src, 3)
-    if isinstance(src, dict):
-        return {k: round_floats(v) for k, v in src.items()}
-    if isinstance(src, (list, tuple)):
-        return [round_floats(x) for x in src]
-    return src
+    src_for_json = [
+        {
+            "url": url_line.url,
+            "count": url_line.count,
+            **{name: round(getattr(url_line, name), 3) for name in FLOAT_FIELDS},
+        }
+        for url_line in url_stats
+    ]
+    return json.dumps(src_for_json)
 
 
 def get_report_file_name(report_dir: Path, file_date: date) -> Path:
@@ -313,6 +599,16 @@ def get_report_file_name(report_dir: Path, file_date: date) -> Path:
     return report_dir.joinpath(rep_file_name)
 
 
+@functools.lru_cache(maxsize=4)
+def load_template(template_file_name: str) -> str:
+    """Чтение шаблона отчета с кешированием по имени файла.
+
+    :arg template_file_name - имя файла шаблона
+    :return: текст шаблона
+    """
+    return Path(template_file_name).read_text(encoding="utf-8")
+
+
 def write_report(
     url_stats: UrlStatsTab, template_file_name: Path, report_file_name: Path
 ) -> None:
@@ -324,20 +620,14 @@ def write_report(
     """
     err_logger = structlog.stdlib.get_logger()
 
-    src_for_json = []
-    for url_line in url_stats:
-        src_for_json.append(asdict(url_line))
-    # json.encoder.FLOAT_REPR = lambda o: format(o, '.3f')
-    tab_json = json.dumps(round_floats(src_for_json), default=str)
+    tab_json = stats_to_json(url_stats)
 
     report_file_name.parent.mkdir(exist_ok=True)
 
     try:
+        file_template = load_template(str(template_file_name))
         with open(report_file_name, mode="wt", encoding="utf-8") as rep_file:
-            with open(template_file_name, mode="rt", encoding="utf-8") as rep_tmpl:
-                file_template = Template(rep_tmpl.read())
-                file_content = file_template.safe_substitute(table_json=tab_json)
-                rep_file.write(file_content)
+            rep_file.write(file_template.replace(TABLE_PLACEHOLDER, tab_json))
     except FileNotFoundError:
         err_logger.error("Template file not found", path=template_file_name)
         return
@@ -1,4 +1,27 @@
-from otus_hw1.log_analyzer import extract_url, extract_time
+import gzip
+import json
+from datetime import date
+
+import numpy as np
+import pytest
+from structlog.testing import capture_logs
+
+from otus_hw1 import log_analyzer
+from otus_hw1.log_analyzer import (
+    FileInfo,
+    LogInfo,
+    UrlStats,
+    calc_median,
+    extract_url,
+    extract_time,
+    gather_stats,
+    get_log_file_name,
+    get_project_root,
+    parse_log_file,
+    process_log,
+    stats_to_json,
+    write_report,
+)
 
 
 def get_good_str() -> str:
@@ -23,6 +46,12 @@ def test_extract_url():
     assert extract_url(get_good_str()) == "/api/v2/banner/1717161"
 
 
+def test_extract_url_post():
+    assert (
+        extract_url(get_good_str().replace("GET", "POST")) == "/api/v2/banner/1717161"
+    )
+
+
 def test_extract_url_not_found():
     assert extract_url(get_bad_str()) == ""
 
@@ -33,3 +62,134 @@ def test_extract_time():
 
 def test_extract_time_wrong_type():
     assert extract_time(get_bad_str()) == 0
+
+
+def test_parse_log_file(tmp_path):
+    log_file = tmp_path / "nginx-access-ui.log-20170630"
+    log_file.write_text(
+        "\n".join(
+            [
+                get_good_str(),
+                get_bad_str(),
+                get_good_str().replace("0.138", "0.000"),
+                get_good_str(),
+            ]
+        ),
+        encoding="utf-8",
+    )
+    parsed = list(parse_log_file(FileInfo(name=str(log_file))))
+    assert parsed == [("/api/v2/banner/1717161", 0.138)] * 2
+
+
+def test_parse_log_file_empty(tmp_path):
+    log_file = tmp_path / "nginx-access-ui.log-20170630"
+    log_file.touch()
+    assert list(parse_log_file(FileInfo(name=str(log_file)))) == []
+
+
+def test_parse_log_file_archive(tmp_path, monkeypatch):
+    log_file = tmp_path / "nginx-access-ui.log-20170630.gz"
+    # Архив из нескольких gzip-потоков с заполнением нулями в конце
+    log_file.write_bytes(
+        gzip.compress((get_good_str() + "\n").encode("utf-8"))
+        + gzip.compress((get_bad_str() + "\n" + get_good_str()).encode("utf-8"))
+        + b"\x00" * 120
+    )
+    monkeypatch.setattr(log_analyzer, "GZIP_BLOCK_SIZE", 50)
+    parsed = list(parse_log_file(FileInfo(name=str(log_file), is_archive=True)))
+    assert parsed == [("/api/v2/banner/1717161", 0.138)] * 2
+
+
+def test_calc_median():
+    assert calc_median(np.array([3.0, 1.0, 2.0])) == 2.0
+    assert calc_median(np.array([4.0, 1.0, 3.0, 2.0])) == 2.5
+    assert calc_median(np.array([0.5])) == 0.5
+
+
+def test_gather_stats_top(tmp_path):
+    log_file = tmp_path / "nginx-access-ui.log-20170630"
+    lines = [
+        get_good_str().replace("1717161", url).replace("0.138", req_time)
+        for url, req_time in [("1", "0.1"), ("2", "3.0"), ("1", "0.5"), ("3", "1.0")]
+    ]
+    log_file.write_text("\n".join(lines), encoding="utf-8")
+    url_stats = gather_stats(process_log(FileInfo(name=str(log_file))), 2)
+    assert [x.url for x in url_stats] == ["/api/v2/banner/2", "/api/v2/banner/3"]
+    assert url_stats[0].count == 1
+    assert url_stats[0].time_perc == pytest.approx(3.0 / 4.6 * 100)
+    url_stats = gather_stats(process_log(FileInfo(name=str(log_file))), 3)
+    assert url_stats[2].count == 2
+    assert url_stats[2].time_med == pytest.approx(0.3)
+
+
+def test_get_log_file_name(tmp_path):
+    (tmp_path / "nginx-access-ui.log-20170630").touch()
+    (tmp_path / "nginx-access-ui.log-20170701.gz").touch()
+    (tmp_path / "nginx-access-ui.log-20170702.bz2").touch()
+    # Папки с подходящим именем пропускаются
+    (tmp_path / "nginx-access-ui.log-20170703").mkdir()
+    file_info = get_log_file_name(tmp_path)
+    assert file_info.name == str(tmp_path / "nginx-access-ui.log-20170701.gz")
+    assert file_info.f_date == date(2017, 7, 1)
+    assert file_info.is_archive
+
+
+def test_gather_stats_empty():
+    assert gather_stats(LogInfo(), 10) == []
+
+
+def test_stats_to_json():
+    url_stats = [UrlStats(url="/api", count=3, time_sum=1.23456, time_med=0.0004)]
+    assert json.loads(stats_to_json(url_stats)) == [
+        {
+            "url": "/api",
+            "count": 3,
+            "count_perc": 0,
+            "time_sum": 1.235,
+            "time_perc": 0,
+            "time_avg": 0,
+            "time_max": 0,
+            "time_med": 0.0,
+        }
+    ]
+
+
+def test_process_log_skipped(tmp_path):
+    log_file = tmp_path / "nginx-access-ui.log-20170630"
+    log_file.write_text("\n".join([get_bad_str()] * 3) + "\n", encoding="utf-8")
+    with capture_logs() as logs:
+        log_info = process_log(FileInfo(name=str(log_file)))
+    assert log_info.url_count == 0
+    assert log_info.skipped_count == 3
+    assert [x["event"] for x in logs] == ["Log lines not parsed"]
+
+
+def test_process_log_parallel(tmp_path, monkeypatch):
+    log_file = tmp_path / "nginx-access-ui.log-20170630"
+    lines = [
+        get_good_str().replace("1717161", str(num % 7)).replace("0.138", f"{num}.5")
+        for num in range(1, 100)
+    ]
+    log_file.write_text("\n".join(lines + [get_bad_str()]), encoding="utf-8")
+    file_info = FileInfo(name=str(log_file))
+    serial_info = process_log(file_info)
+
+    monkeypatch.setattr(log_analyzer, "PARALLEL_MIN_SIZE", 0)
+    monkeypatch.setattr(log_analyzer.os, "cpu_count", lambda: 3)
+    parallel_info = process_log(file_info)
+    assert parallel_info.url_count == serial_info.url_count == 99
+    assert parallel_info.url_total_time == pytest.approx(serial_info.url_total_time)
+    assert gather_stats(parallel_info, 10) == gather_stats(serial_info, 10)
+
+
+def test_write_report(tmp_path):
+    report_file = tmp_path / "reports" / "report-2017.06.30.html"
+    write_report(
+        [UrlStats(url="/api", count=1)],
+        get_project_root() / "report.html",
+        report_file,
+    )
+    report = report_file.read_text(encoding="utf-8")
+    assert 'var table = [{"url": "/api", "count": 1,' in report
+    assert "$table_json" not in report
+    assert '$(".report-table-body")' in report